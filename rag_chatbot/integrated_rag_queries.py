@@ -4,9 +4,12 @@ import os
 import sys
 import argparse
 import logging
+import threading
+from concurrent.futures import Future
 from elasticsearch import Elasticsearch
 
-from utils.rag_pipeline import RAGPipeline, preload_models
+from utils.rag_pipeline import RAGPipeline, RERANK_MODEL
+from utils.model_loading import get_embeddings, get_llm, get_reranker
 from utils.conversation_history import ConversationHistory
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,17 +18,38 @@ logger = logging.getLogger(__name__)
 ES_URL = os.getenv("ES_URL", "http://localhost:9200")
 
 
+def load_in_background(fn, *args) -> Future:
+    """Run a model load on a daemon thread, so exiting early doesn't wait for it."""
+    future: Future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("folder_path")
     parser.add_argument("query")
     args = parser.parse_args()
 
+    # Load models in the background while Elasticsearch is checked
+    futures = [
+        load_in_background(get_embeddings),
+        load_in_background(get_llm),
+        load_in_background(get_reranker, RERANK_MODEL),
+    ]
+
     index_name = os.path.basename(os.path.normpath(args.folder_path)).lower().replace(" ", "_").replace("-", "_")
     if index_name[0] in "_-+":
         index_name = "idx_" + index_name
 
-    es = Elasticsearch(ES_URL, request_timeout=60)
+    es = Elasticsearch(ES_URL, request_timeout=60, http_compress=True)
     if not es.ping():
         logger.error("ES connection failed")
         sys.exit(1)
@@ -33,7 +57,9 @@ def main():
         logger.error(f"Index '{index_name}' not found")
         sys.exit(1)
 
-    preload_models()
+    for f in futures:
+        f.result()
+
     pipeline = RAGPipeline(es, index_name)
     result = pipeline.query(args.query, ConversationHistory())
 
@@ -0,0 +1,75 @@
+"""Tests for utils.batching.MicroBatcher."""
+import threading
+import time
+import unittest
+
+from utils.batching import MicroBatcher
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def test_batches_overlap(self):
+        active = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def slow(items):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            time.sleep(0.2)
+            with lock:
+                active -= 1
+            return items
+
+        batcher = MicroBatcher(slow, max_batch=1, max_in_flight=2)
+        start = time.monotonic()
+        futures = [batcher.submit(i) for i in range(2)]
+        self.assertEqual([f.result(timeout=2) for f in futures], [0, 1])
+        self.assertEqual(peak, 2)
+        self.assertLess(time.monotonic() - start, 0.35)
+
+    def test_single_slot_coalesces_waiting_items(self):
+        sizes = []
+        release = threading.Event()
+
+        def record(items):
+            sizes.append(len(items))
+            release.wait(2)
+            return items
+
+        batcher = MicroBatcher(record, max_in_flight=1)
+        first = batcher.submit(0)
+        time.sleep(0.05)  # first batch is now running
+        rest = [batcher.submit(i) for i in range(1, 6)]
+        release.set()
+        self.assertEqual([f.result(timeout=2) for f in [first] + rest], list(range(6)))
+        self.assertEqual(sizes, [1, 5])
+
+    def test_result_count_mismatch_fails_every_item(self):
+        batcher = MicroBatcher(lambda items: items[:-1], max_batch=3, max_wait=0.05)
+        futures = [batcher.submit(i) for i in range(3)]
+        for f in futures:
+            with self.assertRaises(RuntimeError):
+                f.result(timeout=2)
+
+    def test_base_exception_does_not_stop_batcher(self):
+        class Abort(BaseException):
+            pass
+
+        calls = []
+
+        def fn(items):
+            calls.append(items)
+            if len(calls) == 1:
+                raise Abort()
+            return [x * 2 for x in items]
+
+        batcher = MicroBatcher(fn)
+        with self.assertRaises(Abort):
+            batcher(1)
+        self.assertEqual(batcher(2), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Micro-batching for calls made concurrently from worker threads.
+
+Requests that arrive within a few milliseconds of each other are sent
+downstream as one batch (e.g. a single Elasticsearch msearch).
+"""
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from elastic_transport import ObjectApiResponse
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 32
+MAX_WAIT = 0.005  # seconds to wait for more items after the first arrives
+MAX_IN_FLIGHT = 8  # batches being processed at once
+
+# Elasticsearch.search keyword arguments that map onto an msearch header / body
+MSEARCH_HEADER_KEYS = {
+    "index", "routing", "preference", "request_cache", "search_type",
+    "allow_no_indices", "expand_wildcards", "ignore_unavailable",
+}
+MSEARCH_BODY_KEYS = {
+    "query", "knn", "rank", "size", "from_", "sort", "source", "fields",
+    "aggs", "aggregations", "post_filter", "highlight", "min_score", "rescore",
+    "collapse", "track_total_hits", "track_scores", "explain", "timeout",
+    "terminate_after", "search_after", "script_fields", "stored_fields",
+    "docvalue_fields", "suggest", "runtime_mappings", "version",
+    "seq_no_primary_term", "indices_boost", "ext", "stats", "profile", "pit", "slice",
+}
+BODY_RENAMES = {"from_": "from", "source": "_source"}
+
+
+class MicroBatcher:
+    """Coalesce concurrent single-item calls into one batched call.
+
+    Callers block on their own result. A daemon collector thread gathers items
+    for up to ``max_wait`` seconds or ``max_batch`` items and hands the batch to
+    one of ``max_in_flight`` daemon workers, which call ``batch_fn``. It must
+    return one result per item, in order. When every worker is busy the
+    collector waits, so items queue up and form the next, larger batch.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], Sequence[Any]],
+                 max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT,
+                 name: str = "micro-batcher", max_in_flight: int = MAX_IN_FLIGHT):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+        self._batches: "queue.Queue[List[Tuple[Any, Future]]]" = queue.Queue()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._threads = [threading.Thread(target=self._collect, name=name, daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max_in_flight)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item: Any) -> Future:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        return self.submit(item).result()
+
+    def map(self, items: List[Any]) -> List[Any]:
+        futures = [self.submit(item) for item in items]
+        return [f.result() for f in futures]
+
+    def _collect(self) -> None:
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._batches.put(batch)
+
+    def _work(self) -> None:
+        while True:
+            batch = self._batches.get()
+            try:
+                self._run_batch(batch)
+            finally:
+                self._slots.release()
+
+    def _run_batch(self, batch: List[Tuple[Any, Future]]) -> None:
+        # Every future must be resolved, or its caller blocks forever
+        try:
+            results = list(self.batch_fn([item for item, _ in batch]))
+            if len(results) != len(batch):
+                raise RuntimeError(f"{self.name}: {len(results)} results for {len(batch)} items")
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                logger.exception(f"{self.name}: batch failed")
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+class BatchedSearch:
+    """Elasticsearch client wrapper that sends concurrent searches as one msearch.
+
+    Only ``search`` is intercepted; everything else goes to the wrapped client.
+    Searches using parameters msearch cannot carry, and searches whose msearch
+    item failed, are re-issued directly so callers see the usual errors.
+    """
+
+    def __init__(self, es, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self._es = es
+        self._batcher = MicroBatcher(self._msearch, max_batch, max_wait, name="es-msearch",
+                                     max_in_flight=max_in_flight)
+
+    def __getattr__(self, name: str):
+        return getattr(self._es, name)
+
+    def search(self, *args, **kwargs):
+        if args or not kwargs.keys() <= MSEARCH_HEADER_KEYS | MSEARCH_BODY_KEYS:
+            return self._es.search(*args, **kwargs)
+
+        header = {k: v for k, v in kwargs.items() if k in MSEARCH_HEADER_KEYS}
+        body = {BODY_RENAMES.get(k, k): v for k, v in kwargs.items() if k in MSEARCH_BODY_KEYS}
+        response = self._batcher((header, body))
+        if "error" in response:
+            return self._es.search(**kwargs)
+        return response
+
+    def _msearch(self, items: List[Tuple[Dict, Dict]]) -> List[ObjectApiResponse]:
+        searches = []
+        for header, body in items:
+            searches.extend((header, body))
+
+        resp = self._es.msearch(searches=searches)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"msearch: {len(items)} searches")
+        return [ObjectApiResponse(body=r, meta=resp.meta) for r in resp["responses"]]
@@ -1,8 +1,10 @@
 """Minimal conversation memory."""
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import List, Dict, Optional
 
 MAX_MESSAGES = 10
+MAX_ENTITIES = 20
 
 
 @dataclass
@@ -15,7 +17,7 @@ class Message:
 class ConversationHistory:
     def __init__(self):
         self.messages: List[Message] = []
-        self.entities: List[str] = []
+        self.entities: "OrderedDict[str, None]" = OrderedDict()  # Most recent last
 
     def add_message(self, role: str, content: str, sources=None):
         self.messages.append(Message(role, content, sources))
@@ -23,7 +25,20 @@ class ConversationHistory:
             self.messages = self.messages[-MAX_MESSAGES:]
 
     def add_entities(self, entities: List[str]):
-        self.entities = list(set(self.entities + entities))[-20:]
+        for e in entities:
+            self.entities.pop(e, None)
+            self.entities[e] = None
+        while len(self.entities) > MAX_ENTITIES:
+            self.entities.popitem(last=False)
+
+    def get_entities(self) -> List[str]:
+        return list(self.entities)
+
+    def last_user_message(self) -> Optional[str]:
+        for m in reversed(self.messages):
+            if m.role == "user":
+                return m.content
+        return None
 
     def get_recent_context(self, n: int = 3) -> str:
         return "\n".join(
@@ -33,4 +48,4 @@ class ConversationHistory:
 
     def clear(self):
         self.messages = []
-        self.entities = []
\ No newline at end of file
+        self.entities.clear()
\ No newline at end of file
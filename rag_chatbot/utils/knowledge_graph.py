@@ -4,27 +4,100 @@ Knowledge Graph for RAG Enhancement.
 Hierarchical structure: Document → Section → Chunk
 Rich entity extraction: Standards, Abbreviations, Technical Terms
 """
+import os
 import re
+import mmap
 import pickle
 import logging
-from typing import List, Dict, Set, Optional
+from functools import lru_cache
+from typing import List, Dict, Set, FrozenSet, Optional, Iterable
 import networkx as nx
 
 logger = logging.getLogger(__name__)
 
-# Entity patterns - more comprehensive
-PATTERNS = {
-    "standard": re.compile(r'\b(BS\s*EN\s*\d+[-\d]*|IEC[/\s]*\d+[-\d]*|ISO\s*\d+[-\d]*)\b', re.I),
-    "spec_ref": re.compile(r'\b([SPF][RPOA][-_]?NET[-_]?[A-Z]{3}[-_]?\d{3})\b', re.I),
-    "part_number": re.compile(r'\b([A-Z]{2,4}\d{2,}[-_]?\d*)\b'),
-    "abbreviation": re.compile(r'\b([A-Z]{2,5})\b'),  # Will filter against known list
-}
+# Frame header written by zstandard; marks compressed graph pickles
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Extraction files up to this size are parsed whole with orjson; larger ones stream via ijson
+ORJSON_MAX_BYTES = 512 * 1024 ** 2
+
+HTML_TAG = re.compile(r'<[^>]+>')
+
+PART_NUMBER = re.compile(r'\b[A-Z]{2,4}\d{2,}[-_]?\d*\b')
+
+# Entity patterns as one alternation so each text is scanned once.
+# Group order sets precedence at a given position. Matches don't overlap, so
+# entities nested in a standard or spec ref are recovered in the dispatch:
+# part numbers (BS EN60060, SP-NET-HSE501) and department codes (`dept`).
+ENTITY_PATTERN = re.compile(
+    r'(?i:\b(?P<standard>BS\s*EN\s*\d+[-\d]*|IEC[/\s]*\d+[-\d]*|ISO\s*\d+[-\d]*)\b)'
+    r'|(?i:\b(?P<spec_ref>[SPF][RPOA][-_]?NET[-_]?(?P<dept>[A-Z]{3})[-_]?\d{3})\b)'
+    rf'|(?P<part_number>{PART_NUMBER.pattern})'
+    r'|\b(?P<abbreviation>[A-Z]{2,5})\b'  # Will filter against known list
+)
 
 # Known abbreviations from technical documents
-KNOWN_ABBREVIATIONS = {
+KNOWN_ABBREVIATIONS = frozenset({
     "HTM", "USCD", "SCD", "SPS", "ALS", "FRP", "STL", "RIV", "HTV", "RTV", "LSR",
     "CIGRE", "EATS", "ESI", "CDM", "EAWR", "ESQC", "HASAWA", "HSE", "PSSR"
-}
+})
+
+
+def strip_html(value) -> str:
+    """Remove HTML tags, skipping the regex when there are none."""
+    s = value if isinstance(value, str) else str(value)
+    return HTML_TAG.sub('', s) if '<' in s else s
+
+
+def _extract_entities(text: str) -> Set[str]:
+    """Extract all entity types from text in a single regex pass."""
+    entities = set()
+
+    for m in ENTITY_PATTERN.finditer(text):
+        kind = m.lastgroup
+        val = m.group(kind)
+
+        if kind == "standard":
+            # BS EN 60060-1, IEC 60815, etc.
+            entities.add(_normalize_standard(val))
+            entities.update(_nested_part_numbers(text, m.start(), val))
+        elif kind == "spec_ref":
+            # SP-NET-SST-501, PR-NET-ENG-505
+            entities.add(val.upper().replace(" ", "-"))
+            # Department code set off by hyphens also counts as an abbreviation (HSE)
+            dept = m.group("dept")
+            if dept in KNOWN_ABBREVIATIONS and f"-{dept}-" in val:
+                entities.add(dept)
+            entities.update(_nested_part_numbers(text, m.start(), val))
+        elif kind == "part_number":
+            if len(val) >= 4:  # Filter noise
+                entities.add(val.upper())
+        elif val in KNOWN_ABBREVIATIONS:
+            entities.add(val)
+
+    return entities
+
+
+def _nested_part_numbers(text: str, start: int, val: str) -> Set[str]:
+    """Part numbers inside a reference matched at text[start:], e.g. EN60060 in 'BS EN60060'."""
+    parts = set()
+    for nested in PART_NUMBER.finditer(val):
+        # Re-match against the full text, where the part number may run past the reference
+        full = PART_NUMBER.match(text, start + nested.start())
+        if full and len(full.group()) >= 4:
+            parts.add(full.group().upper())
+    return parts
+
+
+def _normalize_standard(s: str) -> str:
+    """Normalize standard references: 'BS EN 60060-1' → 'BS-EN-60060-1'"""
+    return re.sub(r'\s+', '-', s.upper().strip())
+
+
+@lru_cache(maxsize=1024)
+def _query_entities(query: str) -> FrozenSet[str]:
+    """Memoized entity extraction for repeated queries."""
+    return frozenset(_extract_entities(query))
 
 
 class KnowledgeGraph:
@@ -35,10 +108,17 @@ class KnowledgeGraph:
         self.entity_to_chunks: Dict[str, Set[str]] = {}
         self.chunk_to_entities: Dict[str, Set[str]] = {}
         self.section_to_chunks: Dict[str, Set[str]] = {}
+        self.chunk_to_sections: Dict[str, List[str]] = {}
+        self.chunk_to_doc: Dict[str, str] = {}
+
+    def build_from_chunks(self, chunks: Iterable[Dict]) -> int:
+        """Build hierarchical graph from a single pass over chunks; returns the count."""
+        # Cell text repeats heavily across tables; strip HTML once per distinct string
+        strip_cache: Dict[str, str] = {}
+        count = 0
 
-    def build_from_chunks(self, chunks: List[Dict]) -> None:
-        """Build hierarchical graph from chunks."""
         for chunk in chunks:
+            count += 1
             chunk_id = chunk["chunk_id"]
             doc = chunk["file_name"]
             page = chunk.get("page_number", 0)
@@ -46,11 +126,12 @@ class KnowledgeGraph:
             text = chunk.get("chunk_text", "")
 
             # Document node
-            if not self.graph.has_node(doc):
+            if doc not in self.graph:
                 self.graph.add_node(doc, type="document")
 
             # Chunk node
             self.graph.add_node(chunk_id, type="chunk", page=page, content_type=content_type)
+            self.chunk_to_doc[chunk_id] = doc
 
             # Section hierarchy: doc → section → chunk
             sections = chunk.get("parent_sections", [])
@@ -59,7 +140,7 @@ class KnowledgeGraph:
                 parent = doc
                 for i, sec in enumerate(sections):
                     section_id = f"{doc}::s{sec}"
-                    if not self.graph.has_node(section_id):
+                    if section_id not in self.graph:
                         self.graph.add_node(section_id, type="section", number=sec)
                         self.graph.add_edge(parent, section_id, relation="has_section")
                     parent = section_id
@@ -68,15 +149,16 @@ class KnowledgeGraph:
                     if section_id not in self.section_to_chunks:
                         self.section_to_chunks[section_id] = set()
                     self.section_to_chunks[section_id].add(chunk_id)
+                    self.chunk_to_sections.setdefault(chunk_id, []).append(section_id)
 
                 self.graph.add_edge(parent, chunk_id, relation="contains")
             else:
                 self.graph.add_edge(doc, chunk_id, relation="contains")
 
             # Extract entities
-            entities = self._extract_all_entities(text)
+            entities = _extract_entities(text)
             if chunk.get("has_table") and chunk.get("table_data"):
-                entities.update(self._extract_table_entities(chunk["table_data"]))
+                entities.update(self._extract_table_entities(chunk["table_data"], strip_cache))
 
             # Store entity mappings
             self.chunk_to_entities[chunk_id] = entities
@@ -87,49 +169,32 @@ class KnowledgeGraph:
 
                 # Only add important entities as nodes (standards, specs)
                 if self._is_important_entity(entity):
-                    if not self.graph.has_node(entity):
+                    if entity not in self.graph:
                         self.graph.add_node(entity, type="entity")
                     self.graph.add_edge(chunk_id, entity, relation="references")
 
-        logger.info(f"Graph: {self.graph.number_of_nodes()} nodes, {self.graph.number_of_edges()} edges")
+        logger.info(f"Graph from {count} chunks: {self.graph.number_of_nodes()} nodes, "
+                    f"{self.graph.number_of_edges()} edges")
+        return count
 
-    def _extract_all_entities(self, text: str) -> Set[str]:
-        """Extract all entity types from text."""
-        entities = set()
-
-        # Standards (BS EN 60060-1, IEC 60815, etc.)
-        for m in PATTERNS["standard"].findall(text):
-            entities.add(self._normalize_standard(m))
-
-        # Spec references (SP-NET-SST-501, PR-NET-ENG-505)
-        for m in PATTERNS["spec_ref"].findall(text):
-            entities.add(m.upper().replace(" ", "-"))
-
-        # Part numbers
-        for m in PATTERNS["part_number"].findall(text):
-            if len(m) >= 4:  # Filter noise
-                entities.add(m.upper())
-
-        # Known abbreviations only
-        for m in PATTERNS["abbreviation"].findall(text):
-            if m in KNOWN_ABBREVIATIONS:
-                entities.add(m)
-
-        return entities
-
-    def _normalize_standard(self, s: str) -> str:
-        """Normalize standard references: 'BS EN 60060-1' → 'BS-EN-60060-1'"""
-        return re.sub(r'\s+', '-', s.upper().strip())
-
-    def _extract_table_entities(self, table_data: Dict) -> Set[str]:
+    def _extract_table_entities(self, table_data: Dict,
+                                strip_cache: Optional[Dict[str, str]] = None) -> Set[str]:
         """Extract entities from table cells."""
         entities = set()
+        if strip_cache is None:
+            strip_cache = {}
+
+        def strip(s: str) -> str:
+            clean = strip_cache.get(s)
+            if clean is None:
+                clean = strip_cache[s] = strip_html(s)
+            return clean
 
         # From headers
         for h in table_data.get("headers", []):
             if h and not h.startswith("col_"):
-                clean = re.sub(r'<[^>]+>', '', h)
-                entities.update(self._extract_all_entities(clean))
+                clean = strip(h)
+                entities.update(_extract_entities(clean))
 
         # From cell values
         for row in table_data.get("rows", []):
@@ -137,8 +202,8 @@ class KnowledgeGraph:
                 if isinstance(cell, dict):
                     val = cell.get("value", "")
                     if val:
-                        clean = re.sub(r'<[^>]+>', '', val)
-                        entities.update(self._extract_all_entities(clean))
+                        clean = strip(val)
+                        entities.update(_extract_entities(clean))
 
         return entities
 
@@ -172,54 +237,90 @@ class KnowledgeGraph:
                 related.update(self.entity_to_chunks.get(entity, []))
 
         # Via same section
-        for section_id, chunks in self.section_to_chunks.items():
-            if chunk_id in chunks:
-                related.update(chunks)
+        for section_id in self.chunk_to_sections.get(chunk_id, ()):
+            related.update(self.section_to_chunks[section_id])
 
         related.discard(chunk_id)
         return list(related)[:20]  # Limit
 
     def extract_query_entities(self, query: str) -> List[str]:
         """Extract entities from user query."""
-        return list(self._extract_all_entities(query))
+        return list(_query_entities(query))
 
     def find_documents_by_entity(self, entity: str) -> List[str]:
         """Find documents containing an entity."""
-        chunks = self.find_chunks_by_entity(entity)
-        docs = set()
-        for cid in chunks:
-            # Walk up to document
-            for pred in self.graph.predecessors(cid):
-                node_type = self.graph.nodes[pred].get("type")
-                if node_type == "document":
-                    docs.add(pred)
-                elif node_type == "section":
-                    # Go up from section
-                    for ppred in self.graph.predecessors(pred):
-                        if self.graph.nodes[ppred].get("type") == "document":
-                            docs.add(ppred)
-        return list(docs)
+        return list({
+            self.chunk_to_doc[cid]
+            for cid in self.find_chunks_by_entity(entity)
+            if cid in self.chunk_to_doc
+        })
+
+    def _index_chunk_sections(self) -> Dict[str, List[str]]:
+        """Invert section_to_chunks (graphs saved without chunk_to_sections)."""
+        chunk_to_sections: Dict[str, List[str]] = {}
+        for section_id, chunks in self.section_to_chunks.items():
+            for cid in chunks:
+                chunk_to_sections.setdefault(cid, []).append(section_id)
+        return chunk_to_sections
+
+    def _index_chunk_documents(self) -> Dict[str, str]:
+        """Derive chunk → document by walking up the graph (graphs saved without chunk_to_doc)."""
+        chunk_to_doc = {}
+        for node, d in self.graph.nodes(data=True):
+            if d.get("type") != "chunk":
+                continue
+            # Walk up through the section chain to the document
+            current = node
+            while True:
+                current = next(iter(self.graph.pred[current]), None)
+                if current is None:
+                    break
+                if self.graph.nodes[current].get("type") == "document":
+                    chunk_to_doc[node] = current
+                    break
+        return chunk_to_doc
 
     def save(self, path: str) -> None:
-        """Save graph to disk."""
+        """Save graph to disk (zstd-compressed when zstandard is installed)."""
         data = {
             "graph": self.graph,
             "entity_to_chunks": self.entity_to_chunks,
             "chunk_to_entities": self.chunk_to_entities,
             "section_to_chunks": self.section_to_chunks,
+            "chunk_to_sections": self.chunk_to_sections,
+            "chunk_to_doc": self.chunk_to_doc,
         }
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+
         with open(path, "wb") as f:
-            pickle.dump(data, f)
+            if zstandard is not None:
+                with zstandard.ZstdCompressor(level=3).stream_writer(f) as out:
+                    pickle.dump(data, out, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
         logger.info(f"Saved to {path}")
 
     def load(self, path: str) -> None:
-        """Load graph from disk."""
+        """Load graph from disk (zstd-compressed or plain pickle)."""
         with open(path, "rb") as f:
-            data = pickle.load(f)
+            compressed = f.read(4) == ZSTD_MAGIC
+            f.seek(0)
+            if compressed:
+                import zstandard
+
+                with zstandard.ZstdDecompressor().stream_reader(f) as src:
+                    data = pickle.load(src)
+            else:
+                data = pickle.load(f)
         self.graph = data["graph"]
         self.entity_to_chunks = data["entity_to_chunks"]
         self.chunk_to_entities = data["chunk_to_entities"]
         self.section_to_chunks = data.get("section_to_chunks", {})
+        self.chunk_to_sections = data.get("chunk_to_sections") or self._index_chunk_sections()
+        self.chunk_to_doc = data.get("chunk_to_doc") or self._index_chunk_documents()
         logger.info(f"Loaded: {self.graph.number_of_nodes()} nodes")
 
     def stats(self) -> Dict:
@@ -240,18 +341,27 @@ class KnowledgeGraph:
 
 def build_graph_from_json(json_path: str, output_path: Optional[str] = None) -> KnowledgeGraph:
     """Build graph from extraction JSON."""
-    import ijson
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
 
     kg = KnowledgeGraph()
-    chunks = []
 
-    logger.info(f"Loading {json_path}")
+    logger.info(f"Building graph from {json_path}")
     with open(json_path, "rb") as f:
-        for chunk in ijson.items(f, "chunks.item"):
-            chunks.append(chunk)
-
-    logger.info(f"Building graph from {len(chunks)} chunks")
-    kg.build_from_chunks(chunks)
+        size = os.fstat(f.fileno()).st_size
+        if orjson is not None and 0 < size <= ORJSON_MAX_BYTES:
+            # Parse straight from the page cache, no copy into a Python buffer
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    data = orjson.loads(view)
+            kg.build_from_chunks(data.pop("chunks"))
+        else:
+            import ijson
+
+            # Stream chunks straight into the graph instead of materializing them
+            kg.build_from_chunks(ijson.items(f, "chunks.item"))
 
     if output_path:
         kg.save(output_path)
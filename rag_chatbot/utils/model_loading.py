@@ -1,8 +1,9 @@
 """
-Model loading - LangChain HuggingFace for LLM + Embeddings, GPU only.
+Model loading - LangChain HuggingFace for LLM + Embeddings, on GPU (embeddings optionally ONNX on CPU).
 """
 import os
 import logging
+import threading
 from typing import List
 from functools import lru_cache
 
@@ -10,21 +11,36 @@ from langchain_huggingface import ChatHuggingFace, HuggingFacePipeline, HuggingF
 from sentence_transformers import CrossEncoder
 import torch
 
+from .batching import MicroBatcher
+
 logger = logging.getLogger(__name__)
 
+torch.set_float32_matmul_precision("high")
+
 LLM_MODEL = os.getenv("LLM_MODEL", "Qwen/Qwen2.5-3B-Instruct")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-mpnet-base-v2")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")  # "torch" (GPU) or "onnx" (CPU, ONNX Runtime)
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "")  # e.g. "onnx/model_qint8_avx512_vnni.onnx"
 
 _reranker_cache = {}
+_reranker_lock = threading.Lock()
 
 
 @lru_cache(maxsize=1)
 def get_embeddings() -> HuggingFaceEmbeddings:
-    """Get cached HuggingFace embeddings on GPU."""
-    logger.info(f"Loading embeddings: {EMBED_MODEL}")
+    """Get cached HuggingFace embeddings, on GPU or via ONNX Runtime on CPU."""
+    logger.info(f"Loading embeddings: {EMBED_MODEL} ({EMBED_BACKEND})")
+    if EMBED_BACKEND == "onnx":
+        # Leaves the GPU to the LLM; int8 exports use VNNI kernels where available
+        model_kwargs = {"device": "cpu", "backend": "onnx"}
+        if EMBED_ONNX_FILE:
+            model_kwargs["model_kwargs"] = {"file_name": EMBED_ONNX_FILE}
+    else:
+        # fp16 weights run the encoder on tensor cores
+        model_kwargs = {"device": "cuda", "model_kwargs": {"dtype": torch.float16}}
     return HuggingFaceEmbeddings(
         model_name=EMBED_MODEL,
-        model_kwargs={"device": "cuda"},
+        model_kwargs=model_kwargs,
         encode_kwargs={"normalize_embeddings": True}
     )
 
@@ -52,13 +68,37 @@ def get_llm() -> ChatHuggingFace:
 
 
 def get_reranker(model_name: str) -> CrossEncoder:
-    """Get cached CrossEncoder reranker."""
-    if model_name not in _reranker_cache:
-        logger.info(f"Loading reranker: {model_name}")
-        _reranker_cache[model_name] = CrossEncoder(model_name)
-    return _reranker_cache[model_name]
+    """Get cached CrossEncoder reranker, FP16 on GPU."""
+    reranker = _reranker_cache.get(model_name)
+    if reranker is None:
+        with _reranker_lock:
+            reranker = _reranker_cache.get(model_name)
+            if reranker is None:
+                logger.info(f"Loading reranker: {model_name}")
+                reranker = CrossEncoder(model_name, device="cuda", max_length=256)
+                reranker.model.half()
+                _reranker_cache[model_name] = reranker
+    return reranker
+
+
+@lru_cache(maxsize=1)
+def get_embed_batcher() -> MicroBatcher:
+    """Shared batcher so concurrent requests' query embeddings share a forward pass."""
+    # One forward pass at a time: the GPU gains nothing from overlapping them,
+    # and queued texts join the next batch instead
+    return MicroBatcher(embed_documents, name="embed-batcher", max_in_flight=1)
+
+
+def embed_documents(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of texts in one call, bypassing the query batcher."""
+    return get_embeddings().embed_documents(texts)
 
 
 def embed_query(text: str) -> List[float]:
     """Embed single query text."""
-    return get_embeddings().embed_query(text)
+    return get_embed_batcher()(text)
+
+
+def embed_queries(texts: List[str]) -> List[List[float]]:
+    """Embed several query texts, batched with any other in-flight queries."""
+    return get_embed_batcher().map(texts)
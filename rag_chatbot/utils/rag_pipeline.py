@@ -1,15 +1,17 @@
 """RAG Pipeline with LangGraph state machine."""
 import time
 import logging
-from typing import List, Dict, Optional, TypedDict
+import threading
+from typing import List, Dict, Iterator, Optional, TypedDict
 from elasticsearch import Elasticsearch
+from cachetools import TTLCache
 
 from langgraph.graph import StateGraph, START, END
 from langchain_core.prompts import ChatPromptTemplate
 
 from .optimized_retrieval import search_documents
 from .conversation_history import ConversationHistory
-from .model_loading import get_reranker, get_llm, embed_query, get_embeddings
+from .model_loading import get_reranker, get_llm, embed_query, embed_queries, embed_documents, get_embeddings
 from .table_context import build_context
 from .knowledge_graph import KnowledgeGraph
 
@@ -17,6 +19,8 @@ logger = logging.getLogger(__name__)
 
 FINAL_TOP_K = 10
 RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+SEARCH_CACHE_SIZE = 256  # Retrieval results kept per pipeline, keyed on query text
+SEARCH_CACHE_TTL = 600  # seconds; bounds how long results outlive a reindex
 
 PROMPT = ChatPromptTemplate.from_messages([
     ("system", "You are a technical assistant. Answer using the provided context. Cite sources with file name, page, section."),
@@ -26,6 +30,7 @@ PROMPT = ChatPromptTemplate.from_messages([
 
 class RAGState(TypedDict):
     question: str
+    context_question: str
     results: List[Dict]
     context: str
     answer: str
@@ -39,6 +44,9 @@ def preload_models():
     get_embeddings()
     get_reranker(RERANK_MODEL)
     get_llm()
+    # First forward passes pay CUDA context setup and kernel selection
+    embed_documents(["warmup"] * 8)
+    get_reranker(RERANK_MODEL).predict([("warmup", "warmup")])
     logger.info("Models ready")
 
 
@@ -51,6 +59,8 @@ class RAGPipeline:
         self.kg = knowledge_graph
         self.chain = PROMPT | get_llm()
         self.graph = self._build_graph()
+        self._search_cache: "TTLCache[str, List[Dict]]" = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        self._search_cache_lock = threading.Lock()
 
     def _build_graph(self) -> StateGraph:
         graph = StateGraph(RAGState)
@@ -66,13 +76,49 @@ class RAGPipeline:
 
         return graph.compile()
 
+    def _get_cached_results(self, query: str) -> Optional[List[Dict]]:
+        key = " ".join(query.split())
+        with self._search_cache_lock:
+            return self._search_cache.get(key)
+
+    def _cache_results(self, query: str, results: List[Dict]) -> None:
+        key = " ".join(query.split())
+        with self._search_cache_lock:
+            self._search_cache[key] = results
+
     def _search_node(self, state: RAGState) -> Dict:
-        results = search_documents(
-            self.es, self.index_name, state["question"],
-            embed_query, self.reranker, final_k=FINAL_TOP_K,
-            knowledge_graph=self.kg
-        )
-        return {"results": results}
+        queries = [state["question"]]
+        if state.get("context_question"):
+            queries.append(state["context_question"])
+        results_by_query = {q: self._get_cached_results(q) for q in queries}
+
+        # Embed every uncached variant in one batch, then serve them from the lookup
+        missing = [q for q, r in results_by_query.items() if r is None]
+        if missing:
+            vectors = dict(zip(missing, embed_queries(missing)))
+
+            def embed(text: str) -> List[float]:
+                vector = vectors.get(text)
+                return vector if vector is not None else embed_query(text)
+
+            for q in missing:
+                results_by_query[q] = search_documents(
+                    self.es, self.index_name, q,
+                    embed, self.reranker, final_k=FINAL_TOP_K,
+                    knowledge_graph=self.kg
+                )
+                self._cache_results(q, results_by_query[q])
+
+        # Keep the best-scoring hit per chunk across variants
+        best: Dict[str, Dict] = {}
+        for q in queries:
+            for r in results_by_query[q]:
+                key = r.get("chunk_id")
+                if key not in best or r.get("final_score", 0) > best[key].get("final_score", 0):
+                    best[key] = r
+
+        results = sorted(best.values(), key=lambda r: r.get("final_score", 0), reverse=True)
+        return {"results": results[:FINAL_TOP_K]}
 
     def _build_context_node(self, state: RAGState) -> Dict:
         if not state["results"]:
@@ -99,27 +145,47 @@ class RAGPipeline:
 
         return {"answer": answer, "confidence": confidence}
 
-    def query(self, question: str, conversation: ConversationHistory) -> Dict:
-        start = time.time()
+    def _initial_state(self, question: str, conversation: ConversationHistory) -> RAGState:
+        # Follow-ups are also searched with the previous user turn prepended
+        previous = conversation.last_user_message()
 
-        initial_state: RAGState = {
+        return {
             "question": question,
+            "context_question": f"{previous}\n{question}" if previous is not None else "",
             "results": [],
             "context": "",
             "answer": "",
             "sources": [],
             "confidence": "",
-            "start_time": start
+            "start_time": time.time()
         }
 
-        final_state = self.graph.invoke(initial_state)
-
-        conversation.add_message("user", question)
+    def _finish(self, final_state: RAGState, conversation: ConversationHistory) -> Dict:
+        conversation.add_message("user", final_state["question"])
         conversation.add_message("assistant", final_state["answer"], sources=final_state["sources"])
 
         return {
             "answer": final_state["answer"],
             "sources": final_state["sources"],
-            "query_time": time.time() - start,
+            "query_time": time.time() - final_state["start_time"],
             "metadata": {"num_results": len(final_state["results"]), "confidence": final_state["confidence"]}
         }
+
+    def query(self, question: str, conversation: ConversationHistory) -> Dict:
+        final_state = self.graph.invoke(self._initial_state(question, conversation))
+        return self._finish(final_state, conversation)
+
+    def stream_query(self, question: str, conversation: ConversationHistory) -> Iterator[Dict]:
+        """Yield {"type": "token"} events as the LLM generates, then one {"type": "done"} with the full result."""
+        final_state = None
+        for mode, payload in self.graph.stream(
+            self._initial_state(question, conversation), stream_mode=["messages", "values"]
+        ):
+            if mode == "values":
+                final_state = payload
+                continue
+            chunk, meta = payload
+            if meta.get("langgraph_node") == "generate" and chunk.content:
+                yield {"type": "token", "data": chunk.content}
+
+        yield {"type": "done", **self._finish(final_state, conversation)}
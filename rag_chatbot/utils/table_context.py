@@ -3,11 +3,16 @@ Includes table-title-to-content linking for better answer generation.
 """
 
 import re
-from typing import List, Dict, Optional, Set
+from functools import lru_cache
+from typing import List, Dict, Optional, Set, FrozenSet, Tuple
+
+from .knowledge_graph import strip_html
 
 MAX_CONTEXT_CHARS = 10000  # LongT5 supports 4k tokens (~12k chars)
 MIN_SCORE_RATIO = 0.1
 
+TABLE_TITLE_PATTERN = re.compile(r'Table\s+\d+\.?\d*\s*[-–]\s*([^\n|]+)', re.IGNORECASE)
+
 SYNONYMS = {
     'legislation': {'regulations', 'act', 'law', 'statute'},
     'regulations': {'legislation', 'rules', 'requirements'},
@@ -15,6 +20,8 @@ SYNONYMS = {
     'standards': {'specifications', 'requirements', 'documents'},
 }
 
+STOPWORDS = frozenset({'the', 'and', 'for', 'with', 'from', 'are', 'was', 'were', 'been', 'table', 'col'})
+
 
 def _filter_by_score(chunks: List[Dict], min_ratio: float = MIN_SCORE_RATIO) -> List[Dict]:
     """Keep only chunks with score >= min_ratio * top_score."""
@@ -34,6 +41,11 @@ def _get_adjacent_chunks(top_chunks: List[Dict], all_results: List[Dict]) -> Lis
     if not all_results:
         return top_chunks
 
+    # First result per (doc, page), so adjacent lookups are O(1)
+    by_doc_page: Dict[Tuple[str, int], Dict] = {}
+    for candidate in all_results:
+        by_doc_page.setdefault((candidate.get("file_name"), candidate.get("page_number")), candidate)
+
     included = set()
     expanded = []
 
@@ -56,33 +68,37 @@ def _get_adjacent_chunks(top_chunks: List[Dict], all_results: List[Dict]) -> Lis
             if key in included:
                 continue
 
-            for candidate in all_results:
-                if candidate.get("file_name") == doc and candidate.get("page_number") == adj_page:
-                    expanded.append(candidate)
-                    included.add(key)
-                    break
+            candidate = by_doc_page.get(key)
+            if candidate is not None:
+                expanded.append(candidate)
+                included.add(key)
 
     return expanded
 
 
-def _extract_keywords(text: str) -> Set[str]:
-    """Extract meaningful keywords from text."""
-    stopwords = {'the', 'and', 'for', 'with', 'from', 'are', 'was', 'were', 'been', 'table', 'col'}
-    text_clean = re.sub(r'<[^>]+>', '', text.lower())
+@lru_cache(maxsize=4096)
+def _extract_keywords(text: str) -> FrozenSet[str]:
+    """Extract meaningful keywords from text (memoized per string)."""
+    text_clean = strip_html(text.lower())
     words = re.findall(r'\b[a-z]{3,}\b', text_clean)
-    return {w for w in words if w not in stopwords}
+    return frozenset(w for w in words if w not in STOPWORDS)
 
 
-def _expand_with_synonyms(keywords: Set[str]) -> Set[str]:
-    """Expand keywords with synonyms."""
+@lru_cache(maxsize=4096)
+def _expand_with_synonyms(keywords: FrozenSet[str]) -> FrozenSet[str]:
+    """Expand keywords with synonyms (memoized per keyword set)."""
     expanded = set(keywords)
     for kw in keywords:
         if kw in SYNONYMS:
             expanded.update(SYNONYMS[kw])
-    return expanded
+    return frozenset(expanded)
 
 
-def _score_table_match(table_chunk: Dict, title_keywords: Set[str]) -> int:
+def _score_table_match(
+    table_chunk: Dict,
+    title_keywords: FrozenSet[str],
+    expanded_title: Optional[FrozenSet[str]] = None
+) -> int:
     """Score how well a table matches title keywords."""
     if not title_keywords:
         return 0
@@ -90,7 +106,8 @@ def _score_table_match(table_chunk: Dict, title_keywords: Set[str]) -> int:
     table_text = table_chunk.get('chunk_text', '')
     table_keywords = _extract_keywords(table_text)
     
-    expanded_title = _expand_with_synonyms(title_keywords)
+    if expanded_title is None:
+        expanded_title = _expand_with_synonyms(title_keywords)
     expanded_table = _expand_with_synonyms(table_keywords)
     
     direct_matches = len(title_keywords & table_keywords)
@@ -99,28 +116,36 @@ def _score_table_match(table_chunk: Dict, title_keywords: Set[str]) -> int:
     return direct_matches * 2 + synonym_matches
 
 
+def _tables_by_page(all_results: List[Dict]) -> Dict[Tuple[str, int], List[Dict]]:
+    """Bucket table chunks by (file_name, page_number)."""
+    buckets: Dict[Tuple[str, int], List[Dict]] = {}
+    for c in all_results:
+        if c.get("has_table") and c.get("table_data"):
+            buckets.setdefault((c.get("file_name"), c.get("page_number")), []).append(c)
+    return buckets
+
+
 def _find_best_matching_table(
     title: str, 
     page: int, 
     file_name: str, 
-    all_results: List[Dict],
+    tables_by_page: Dict[Tuple[str, int], List[Dict]],
     exclude_ids: Set[str]
 ) -> Optional[Dict]:
     """Find best matching table not already in exclude_ids."""
     title_keywords = _extract_keywords(title)
     
     page_tables = [
-        c for c in all_results
-        if c.get("page_number") == page
-        and c.get("file_name") == file_name
-        and c.get("has_table") and c.get("table_data")
-        and c.get("chunk_id") not in exclude_ids
+        c for c in tables_by_page.get((file_name, page), [])
+        if c.get("chunk_id") not in exclude_ids
     ]
     
     if not page_tables:
         return None
     
-    scored = [(tc, _score_table_match(tc, title_keywords)) for tc in page_tables]
+    # Title side is the same for every candidate; expand it once
+    expanded_title = _expand_with_synonyms(title_keywords)
+    scored = [(tc, _score_table_match(tc, title_keywords, expanded_title)) for tc in page_tables]
     scored.sort(key=lambda x: x[1], reverse=True)
     
     best_table, best_score = scored[0]
@@ -136,7 +161,7 @@ def _link_table_titles_to_content(chunks: List[Dict], all_results: List[Dict]) -
     if not all_results:
         return chunks
 
-    table_title_pattern = re.compile(r'Table\s+\d+\.?\d*\s*[-–]\s*([^\n|]+)', re.IGNORECASE)
+    tables_by_page = _tables_by_page(all_results)
     included_ids = {c.get("chunk_id") for c in chunks}
     additional = []
 
@@ -145,14 +170,17 @@ def _link_table_titles_to_content(chunks: List[Dict], all_results: List[Dict]) -
             continue
 
         text = chunk.get("chunk_text", "")
-        matches = table_title_pattern.findall(text)
+        # Cheap substring gate; most body chunks never mention a table
+        if "table" not in text.lower():
+            continue
+        matches = TABLE_TITLE_PATTERN.findall(text)
         
         for title in matches:
             title = title.strip()
             page = chunk.get("page_number", 0)
             doc = chunk.get("file_name", "")
             
-            matched_table = _find_best_matching_table(title, page, doc, all_results, included_ids)
+            matched_table = _find_best_matching_table(title, page, doc, tables_by_page, included_ids)
             if matched_table:
                 additional.append(matched_table)
                 included_ids.add(matched_table.get("chunk_id"))
@@ -177,22 +205,27 @@ def build_context(chunks: List[Dict], all_results: Optional[List[Dict]] = None)
         if not content:
             continue
 
+        remaining = MAX_CONTEXT_CHARS - chars
+        if remaining <= 0:
+            break
+
         doc = c.get("file_name", "unknown")
         page = c.get("page_number", 0)
         section = c.get("section", "")
         section_str = f" | {section}" if section else ""
         header = f"[{doc} | Page {page}{section_str}]"
-        entry = f"{header}\n{content}\n"
 
-        remaining = MAX_CONTEXT_CHARS - chars
-        if remaining <= 0:
+        # Size the entry before building it; the last one only copies what fits
+        entry_len = len(header) + len(content) + 2
+        if entry_len > remaining:
+            if remaining <= len(header):
+                parts.append(header[:remaining])
+            else:
+                parts.append(f"{header}\n{content[:remaining - len(header) - 1]}")
             break
 
-        if len(entry) > remaining:
-            entry = entry[:remaining]
-
-        parts.append(entry)
-        chars += len(entry)
+        parts.append(f"{header}\n{content}\n")
+        chars += entry_len
 
     return "\n".join(parts)
 
@@ -222,19 +255,24 @@ def _semantic_to_text(table_data: Dict) -> str:
     if not rows:
         return ""
 
+    # Header labels are the same for every row; clean them once
+    labels = []
+    for h in headers:
+        clean_h = strip_html(h) if h else ''
+        labels.append(clean_h if clean_h and not clean_h.startswith('col_') else None)
+    columns = list(zip(headers, labels))
+
+    strip = strip_html
     lines = []
     for row in rows:
+        get = row.get
         parts = []
-        for h in headers:
-            cell = row.get(h, {})
+        for h, label in columns:
+            cell = get(h, {})
             val = cell.get('value', '') if isinstance(cell, dict) else str(cell)
-            val = re.sub(r'<[^>]+>', '', str(val)) if val else ''
+            val = strip(val) if val else ''
             if val:
-                clean_h = re.sub(r'<[^>]+>', '', str(h)) if h else ''
-                if clean_h and not clean_h.startswith('col_'):
-                    parts.append(f"{clean_h}: {val}")
-                else:
-                    parts.append(val)
+                parts.append(f"{label}: {val}" if label else val)
         if parts:
             lines.append(", ".join(parts))
 
@@ -250,15 +288,14 @@ def _coordinate_to_text(table_info: Dict) -> str:
     if not data:
         return ""
 
-    headers = [str(data.get(f"{c},0", "")) for c in range(num_cols)]
+    get = data.get
+    headers = [str(get(f"{c},0", "")) for c in range(num_cols)]
+    # Columns without a header never produce output; skip their lookups
+    labeled = [(c, h) for c, h in enumerate(headers) if h]
     lines = []
 
     for r in range(1, num_rows):
-        parts = []
-        for c in range(num_cols):
-            val = str(data.get(f"{c},{r}", ""))
-            if val and headers[c]:
-                parts.append(f"{headers[c]}: {val}")
+        parts = [f"{h}: {val}" for c, h in labeled if (val := str(get(f"{c},{r}", "")))]
         if parts:
             lines.append(", ".join(parts))
 
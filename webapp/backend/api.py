@@ -2,50 +2,123 @@
 from pathlib import Path
 import sys
 import os
+import asyncio
+import hashlib
 RAG_CHATBOT_DIR = Path(__file__).resolve().parent.parent.parent / "rag_chatbot"
 sys.path.insert(0, str(RAG_CHATBOT_DIR))
 
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from pydantic import BaseModel, Field
+from typing import AsyncIterator, List, Dict, Optional
 from elasticsearch import Elasticsearch
 import logging
+import logging.handlers
+import queue
+import orjson
+from cachetools import TTLCache
 
 from utils.rag_pipeline import RAGPipeline, preload_models
 from utils.conversation_history import ConversationHistory
 from utils.knowledge_graph import KnowledgeGraph
+from utils.batching import BatchedSearch
+from utils.model_loading import embed_documents
 
-app = FastAPI()
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+
+# The QueueHandler only merges args (and any traceback) into the message in
+# the calling thread; the level/logger prefix and the stderr write are done
+# by the listener thread
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+logging.basicConfig(level=LOG_LEVEL, handlers=[_queue_handler])
+logger = logging.getLogger(__name__)
 
 ES_URL = os.getenv("ES_URL", "http://localhost:9200")
 INDEX_NAME = os.getenv("RAG_INDEX", "sse_specs")
 GRAPH_PATH = os.getenv("GRAPH_PATH", "")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # seconds
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "86400"))  # seconds since last use
+MAX_EMBED_BATCH = int(os.getenv("MAX_EMBED_BATCH", "256"))
+# Comma-separated; empty means same-origin only (the frontend is served through nginx)
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 
-es = Elasticsearch(ES_URL, request_timeout=60)
-preload_models()
-conversation = ConversationHistory()
+# Compressed responses and a keep-alive pool sized for concurrent requests
+es = Elasticsearch(ES_URL, request_timeout=60, http_compress=True,
+                   connections_per_node=64, retry_on_timeout=True)
+# The caches themselves are only touched from the event loop. A session's
+# ConversationHistory is also read and appended to by pipeline worker threads,
+# so it is guarded by the session's lock (see Session)
+sessions = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
 
-kg = None
-if GRAPH_PATH and os.path.exists(GRAPH_PATH):
+
+def load_knowledge_graph() -> Optional[KnowledgeGraph]:
+    """Load the graph at GRAPH_PATH, if one is configured."""
+    if not (GRAPH_PATH and os.path.exists(GRAPH_PATH)):
+        return None
     kg = KnowledgeGraph()
     kg.load(GRAPH_PATH)
-    logger.info(f"Knowledge graph loaded: {kg.stats()}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Knowledge graph loaded: {kg.stats()}")
+    return kg
+
+
+def warm_up(pipeline: RAGPipeline) -> None:
+    """Run one query end to end so the first user request doesn't pay cold-start costs."""
+    try:
+        es.cluster.health(wait_for_status="yellow", timeout="30s")
+        pipeline.query("warmup", ConversationHistory())
+    except Exception as e:
+        logger.warning(f"Warmup failed, first requests may be slow: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _log_listener.start()
+
+    # Models and graph are independent; load them side by side
+    _, kg = await asyncio.gather(
+        asyncio.to_thread(preload_models),
+        asyncio.to_thread(load_knowledge_graph),
+    )
+    # Concurrent requests' searches are coalesced into msearch calls
+    app.state.pipeline = RAGPipeline(BatchedSearch(es), INDEX_NAME, knowledge_graph=kg)
+    await asyncio.to_thread(warm_up, app.state.pipeline)
+    yield
+    _log_listener.stop()
+
 
-pipeline = RAGPipeline(es, INDEX_NAME, knowledge_graph=kg)
+app = FastAPI(lifespan=lifespan)
+
+if CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type"],
+        max_age=86400,  # browsers reuse the preflight for a day
+    )
+# Source previews compress well; small responses go out as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 class QueryRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None
+    stream: bool = False
 
 
 class Source(BaseModel):
@@ -63,9 +136,65 @@ class QueryResponse(BaseModel):
     metadata: Dict
 
 
-@app.post("/query")
-def query(req: QueryRequest):
-    result = pipeline.query(req.question, conversation)
+class EmbedBatchRequest(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=MAX_EMBED_BATCH)
+
+
+class EmbedBatchResponse(BaseModel):
+    embeddings: List[List[float]]
+
+
+def orjson_response(content) -> Response:
+    """Serialize with orjson and skip FastAPI's response encoding/validation."""
+    return Response(orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY),
+                    media_type="application/json")
+
+
+def ndjson_line(event: Dict) -> bytes:
+    return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+
+
+@dataclass
+class Session:
+    conversation: ConversationHistory = field(default_factory=ConversationHistory)
+    # Held for a whole request, so one session's turns are read and appended in order
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+def get_session(session_id: Optional[str]) -> Session:
+    """State for a session; requests without one get a fresh, unshared session."""
+    if not session_id:
+        return Session()
+    session = sessions.get(session_id)
+    if session is None:
+        session = Session()
+    # Re-insert so the TTL counts from the last request
+    sessions[session_id] = session
+    return session
+
+
+def question_key(question: str, conversation: ConversationHistory) -> str:
+    """Cache key for a question in its conversation, insensitive to case and whitespace.
+
+    Follow-ups are retrieved together with the previous user turn, so that turn
+    is part of the key; otherwise one session's follow-up answer would be served
+    to another session asking the same follow-up.
+    """
+    parts = [question]
+    previous = conversation.last_user_message()
+    if previous is not None:
+        parts.insert(0, previous)
+    text = "\0".join(" ".join(p.lower().split()) for p in parts)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def replay_cached(conversation: ConversationHistory, question: str, response: Dict) -> None:
+    """Keep the conversation consistent with a cached answer the client is shown."""
+    conversation.add_message("user", question)
+    conversation.add_message("assistant", response["answer"], sources=response["sources"])
+
+
+def to_response(result: Dict) -> Dict:
     return {
         "answer": result["answer"],
         "sources": result["sources"],
@@ -73,6 +202,62 @@ def query(req: QueryRequest):
     }
 
 
+async def stream_answer(question: str, session: Session) -> AsyncIterator[bytes]:
+    """NDJSON events: one per generated token, then a final "done" with the full response."""
+    async with session.lock:
+        conversation = session.conversation
+        key = question_key(question, conversation)
+        response = response_cache.get(key)
+        if response is not None:
+            replay_cached(conversation, question, response)
+            yield ndjson_line({"type": "done", **response})
+            return
+
+        try:
+            async for event in iterate_in_threadpool(app.state.pipeline.stream_query(question, conversation)):
+                if event["type"] != "done":
+                    yield ndjson_line(event)
+                    continue
+                response = to_response(event)
+                response_cache[key] = response
+                yield ndjson_line({"type": "done", **response})
+        except Exception:
+            # Headers are already sent, so report the failure in-band
+            logger.exception("Streaming query failed")
+            yield ndjson_line({"type": "error", "detail": "Query failed"})
+
+
+# response_model only documents the shape; the Response is returned as-is
+@app.post("/query", response_model=QueryResponse)
+async def query(req: QueryRequest):
+    session = get_session(req.session_id)
+    if req.stream:
+        return StreamingResponse(stream_answer(req.question, session),
+                                 media_type="application/x-ndjson")
+
+    async with session.lock:
+        conversation = session.conversation
+        key = question_key(req.question, conversation)
+        response = response_cache.get(key)
+
+        if response is None:
+            # Retrieval + generation block; keep them off the event loop
+            result = await run_in_threadpool(app.state.pipeline.query, req.question, conversation)
+            response = to_response(result)
+            response_cache[key] = response
+        else:
+            replay_cached(conversation, req.question, response)
+
+    return orjson_response(response)
+
+
+@app.post("/embed-batch", response_model=EmbedBatchResponse)
+async def embed_batch(req: EmbedBatchRequest):
+    # One forward pass for the whole batch, for ingest/backfill clients
+    embeddings = await run_in_threadpool(embed_documents, req.texts)
+    return orjson_response({"embeddings": embeddings})
+
+
 @app.get("/health")
 def health():
     return {"status": "ok", "index": INDEX_NAME}